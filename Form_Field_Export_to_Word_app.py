@@ -1,10 +1,14 @@
 import streamlit as st
 import openpyxl
-from openpyxl.utils.cell import get_column_letter
 import pandas as pd
+from pandas.io.parsers import TextParser
+import numpy as np
+import copy
 import io
 import os
 import re
+import tempfile
+import time
 import zipfile
 from docx import Document
 from docx.shared import Inches, RGBColor, Pt
@@ -21,6 +25,41 @@ st.set_page_config(
 )
 
 
+# --- Constants ---
+
+# Field IDs (column 6) whose blank ECCAIRS columns 14-15 are filled from the row above during
+# pre-processing (only for "Dropdown select" fields).
+VALID_FIELD_IDS = frozenset({10, 11, 12, 14, 15, 17, 18, 19, 28, 29, 30, 94, 103, 104, 107, 108, 109, 117,
+                            119, 120, 122, 128, 130, 131, 142, 160, 168, 170, 206, 208, 209, 212, 214, 216,
+                            217, 220, 221, 222, 223, 224, 225, 226, 227, 228, 284, 292, 293, 311, 314, 315,
+                            316, 320, 325, 326, 371, 431, 980, 995, 1391, 1401, 1404, 1672, 1673, 1759, 2329,
+                            2440, 2472, 2473, 2485, 2486, 2500, 2502, 3282, 3708, 3709, 3875, 4240, 4243,
+                            4244, 4245, 5894, 5901, 5940, 7349, 8829, 8830, 9114, 9115, 9116, 9117, 9118, 9119,
+                            9120, 9121, 9122, 9126, 9127, 9128, 9129, 9130, 9135, 9136, 9137, 9138, 9139, 9140,
+                            9141, 9142, 9143, 9144, 9145, 9150, 9151, 9152, 9153, 9154, 9155, 9156, 9157, 9158,
+                            9179, 9180, 9181, 9189, 9191, 9192, 9201, 9202, 9203, 9204, 9205, 9206, 9207, 9208,
+                            9276, 9277, 9278, 9279, 9280, 9281, 9282, 9298, 9299, 9333, 9529, 9540, 9543, 9544,
+                            9552, 9557, 9565, 10614, 10618, 12739, 12960, 15463, 23157, 23159})
+
+# Patterns stripped by safe_text_for_docx, compiled once as it runs for every field and option
+XML_NAMESPACE_RE = re.compile(r'\{http.*?\}', re.IGNORECASE)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Border elements and qualified attribute names used by add_cell_border, resolved once
+CELL_BORDER_TAGS = ('w:top', 'w:left', 'w:bottom', 'w:right')
+QN_W_VAL = qn('w:val')
+QN_W_SZ = qn('w:sz')
+QN_W_SPACE = qn('w:space')
+QN_W_COLOR = qn('w:color')
+
+# Combined size of the generated documents from which the download ZIP is deflated instead of stored
+ZIP_DEFLATE_THRESHOLD = 8_000_000
+
+# Paragraph indents used in the generated forms (Length values are immutable, so they are built once)
+INDENT_HALF_INCH = Inches(0.5)
+INDENT_ONE_INCH = Inches(1.0)
+
+
 # --- Utility Functions for Streamlit ---
 
 def st_display_warning(title, message):
@@ -38,20 +77,60 @@ def add_cell_border(cell, color_rgb=(0x00, 0x00, 0x00), size_pt=4):
     tc = cell._tc
     tcPr = tc.get_or_add_tcPr()
 
-    # Define border attributes
-    borders = ['top', 'left', 'bottom', 'right']
-    for border in borders:
+    # Border attributes are the same for all four sides
+    size = str(size_pt)  # Size in 1/8 of a point
+    color = f'{color_rgb[0]:02X}{color_rgb[1]:02X}{color_rgb[2]:02X}'  # Color in hex
+
+    for tag in CELL_BORDER_TAGS:
         # Create the border element
-        tag = qn(
-            f'w:{border}')
         e = OxmlElement(tag)
-        e.set(qn('w:val'), 'single')  # Border style
-        e.set(qn('w:sz'), str(size_pt))  # Size in 1/8 of a point
-        e.set(qn('w:space'), '0')
-        e.set(qn('w:color'), f'{color_rgb[0]:02X}{color_rgb[1]:02X}{color_rgb[2]:02X}')  # Color in hex
+        e.set(QN_W_VAL, 'single')  # Border style
+        e.set(QN_W_SZ, size)
+        e.set(QN_W_SPACE, '0')
+        e.set(QN_W_COLOR, color)
         tcPr.append(e)
 
 
+def add_option_bullets(document, options):
+    """
+    Adds one indented 'List Bullet' paragraph per option. The styled paragraph is built once and its
+    XML element is cloned for every option, which avoids the per-paragraph style lookup of add_paragraph.
+    """
+    prototype = document.add_paragraph(style='List Bullet')
+    prototype.paragraph_format.left_indent = INDENT_ONE_INCH
+    prototype_p = prototype._p
+
+    for option in options:
+        # Use safe_text_for_docx here for high-volume content
+        safe_option = safe_text_for_docx(option)
+        option_p = copy.deepcopy(prototype_p)
+        if safe_option:
+            option_p.add_r().text = safe_option
+        prototype_p.addprevious(option_p)
+
+    prototype_p.getparent().remove(prototype_p)
+
+
+class FilenameCharTable(dict):
+    """
+    str.translate table that deletes every character that is not alphanumeric or whitespace.
+    Entries are filled in on first use, so only the characters actually seen are ever stored.
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        self[codepoint] = char if char.isalnum() or char.isspace() else None
+        return self[codepoint]
+
+
+FILENAME_CHAR_TABLE = FilenameCharTable()
+
+
+def clean_filename_part(value):
+    """Keeps only alphanumeric and whitespace characters, trims, and replaces spaces with underscores."""
+    return str(value).translate(FILENAME_CHAR_TABLE).strip().replace(" ", "_")
+
+
 # --- REVISED: Aggressive Text cleaning for DOCX insertion ---
 def safe_text_for_docx(value):
     """
@@ -63,17 +142,90 @@ def safe_text_for_docx(value):
 
     s = str(value)
 
+    # Each step below only runs when the characters it targets are present; the membership
+    # tests are single C-level scans, so clean text is not copied once per step.
+
     # 1. Remove non-ASCII/non-printable control characters using encode/decode
-    s = s.encode('ascii', 'ignore').decode('ascii')
+    if not s.isascii():
+        s = s.encode('ascii', 'ignore').decode('ascii')
 
     # 2. Clean up common XML/HTML-like fragments that cause the reported error
     # Target the known fragments like '{http'
-    s = re.sub(r'\{http.*?\}', '', s, flags=re.IGNORECASE)
-    s = re.sub(r'<[^>]+>', '', s)  # Remove stray HTML/XML tags
-    s = s.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&') # Decode basic HTML entities
+    if '{' in s:
+        s = XML_NAMESPACE_RE.sub('', s)
+    if '<' in s:
+        s = HTML_TAG_RE.sub('', s)  # Remove stray HTML/XML tags
+    if '&' in s:
+        s = s.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&') # Decode basic HTML entities
+
+    # 3. Trim (non-breaking spaces are non-ASCII, so step 1 has already removed them)
+    return s.strip()
+
+
+def rows_to_dataframe(rows):
+    """
+    Builds the DataFrame pd.read_excel would return for these sheet values (first row is the header),
+    without writing the rows to an XLSX file and parsing it again. One difference: completely empty
+    rows are dropped here, while pd.read_excel keeps empty rows between data rows as all-NaN rows.
+    process_excel_st forward-fills columns 1-10 of the data rows first, so such rows do not reach it in practice.
+    """
+    # pandas' Excel reader hands empty cells to the parser as ""
+    data = [[convert_cell_value(value) for value in row] for row in rows]
+    data = [row for row in data if any(value != "" for value in row)]
+    # TextParser is not part of the public pandas API, but it is the parser pd.read_excel itself
+    # uses, so it gives the same type inference; check it when upgrading pandas
+    return TextParser(data, header=0).read()
+
+
+def convert_cell_value(value):
+    """
+    Converts a cell value the way pandas' openpyxl reader does before parsing: empty cells become ""
+    and whole-number floats become ints (Excel stores all numbers as floats, e.g. 1001.0 -> 1001).
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def ffill_blanks(values, blank):
+    """
+    Replaces every value flagged in `blank` with the nearest unflagged value above it, column by column.
+    `values` and `blank` are equally shaped 2-D arrays (rows x columns).
+    """
+    source_rows = np.where(blank, 0, np.arange(len(values))[:, None])
+    return np.take_along_axis(values, np.maximum.accumulate(source_rows, axis=0), axis=0)
 
-    # 3. Explicitly remove non-breaking spaces (can also cause issues) and trim
-    return s.replace('\xa0', ' ').strip()
+
+def group_options_by_field(df):
+    """
+    Maps each Field ID to its unique valid options, in order of appearance.
+    Expects the standardized DataFrame of the generation phase, where both columns are strings.
+    """
+    option_rows = df[(df["Option"].str.lower() != "n/a") & (df["Option"].notna())]
+    return {
+        field_id: options.unique().tolist()
+        for field_id, options in option_rows.groupby("Field ID", sort=False)["Option"]
+    }
+
+
+def find_large_dropdowns(df):
+    """Returns (Field ID, Field Description, option count) for every dropdown field with more than 50 options."""
+    field_ids = df["Field ID"].astype(str)
+
+    # Count the unique options of every Field ID in one pass
+    is_option = (df["Option"].astype(str).str.lower() != "n/a") & (df["Option"].notna())
+    options_count = df.loc[is_option, "Option"].groupby(field_ids[is_option]).nunique()
+
+    # Use the same column names as used in the generation functions
+    unique_dropdowns = df[
+        df["Field Type"].astype(str).str.strip().str.lower() == "dropdown select"
+        ].drop_duplicates(subset=["Field ID"])
+
+    return [(field_id, field_desc, int(options_count[field_id]))
+            for field_id, field_desc in zip(field_ids[unique_dropdowns.index], unique_dropdowns["Field Description"])
+            if options_count.get(field_id, 0) > 50]
 
 
 # --- Excel Pre-processing Function (PHASE 1) ---
@@ -82,35 +234,51 @@ def process_excel_st(uploaded_file, sheet_name="Worksheet", start_row=1):
     Takes the uploaded form/fields export and processes it in memory (filling blanks, deleting rows).
     """
     try:
-        # Load workbook from the uploaded file's bytes buffer
-        workbook_data = uploaded_file.read()
-        wb = openpyxl.load_workbook(io.BytesIO(workbook_data))
+        # Load workbook directly from the uploaded file, which is already an in-memory file-like buffer
+        # (no read() + BytesIO copy). Rewind first: a previous run may have left it at the end.
+        # Read-only mode streams the cell values instead of building the full styled cell graph.
+        uploaded_file.seek(0)
+        wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
 
         # Check if the required sheet exists
         if sheet_name not in wb.sheetnames:
             st_display_error("Error",
                              f"Sheet '{sheet_name}' not found in the uploaded file. Available sheets: {', '.join(wb.sheetnames)}")
+            wb.close()
             return None, None
 
         sheet = wb[sheet_name]
 
         st.info("Starting Excel Pre-processing...")
 
-        end_row_for_processing = sheet.max_row
-        end_row_for_deletion = sheet.max_row
+        # Read all values in a single pass; every step below works on these plain lists (1-based row/column
+        # numbers are kept in the messages, hence the "- 1" offsets). Rows are padded to a common width.
+        # The <dimension> record of the sheet can be stale or missing; read-only mode would trust it and
+        # cut the rows short, so let iter_rows find the real extent instead (as pd.read_excel does)
+        sheet.reset_dimensions()
+        rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+        wb.close()
+        max_col = max([15] + [len(row) for row in rows])
+        for row in rows:
+            row.extend([None] * (max_col - len(row)))
+        max_row = len(rows)
+
+        end_row_for_processing = max_row
+        end_row_for_deletion = max_row
 
         # Step 1: Find the "Bird species" row and determine the actual end_row
         bird_species_found_at_row = None
-        for row_index in range(start_row, sheet.max_row + 1):
-            # Check cell 7 (G) for "Bird species"
-            cell_value_col7 = sheet.cell(row=row_index, column=7).value
+        position_id_value = None
+        for row_index, row in enumerate(rows[start_row - 1:], start=start_row):
+            # Check cell 7 (G) for "Bird species", keeping cell 8 (H) from the same row
+            cell_value_col7 = row[6]
             if isinstance(cell_value_col7, str) and cell_value_col7.strip() == "Bird species":
                 bird_species_found_at_row = row_index
+                position_id_value = row[7]
                 break
 
         if bird_species_found_at_row is not None:
             # Check cell 8 (H) for "Position ID"
-            position_id_value = sheet.cell(row=bird_species_found_at_row, column=8).value
             if position_id_value is None or str(position_id_value).strip() == "":
                 st.write(
                     f"ℹ️ **'Bird species' found** with a BLANK 'Position ID'. Rows after row {bird_species_found_at_row - 1} **WILL BE removed**.")
@@ -125,80 +293,49 @@ def process_excel_st(uploaded_file, sheet_name="Worksheet", start_row=1):
         if end_row_for_processing < start_row:
             st_display_warning("Excel Processing Warning",
                                f"Calculated end row for processing ({end_row_for_processing}) is less than start_row ({start_row}). No filling operations will be performed.")
-            # Still save the workbook in case it had header content
-            output_buffer = io.BytesIO()
-            wb.save(output_buffer)
+            # Still return the data in case it had header content
             # The second return value (valid_values) is not used if processing is skipped, but we return an empty set for consistency.
-            return output_buffer.getvalue(), set()
+            return rows_to_dataframe(rows), frozenset()
 
         if end_row_for_processing >= start_row:
+            # Work on the processing range as an object DataFrame. The header row is kept as the first
+            # row so it seeds the forward fill, but it is never filled itself.
+            block = pd.DataFrame(rows[start_row - 1:end_row_for_processing], dtype=object)
+
             # Fill blank cells in columns 1 to 10 (excluding headers, hence start_row + 1)
             st.write("Filling blanks in columns 1-10...")
-            for col_index in range(1, 11):
-                col_letter = get_column_letter(col_index)
-                for row_index in range(start_row + 1, end_row_for_processing + 1):
-                    current_cell = sheet[f"{col_letter}{row_index}"]
-                    if current_cell.value is None or (
-                            isinstance(current_cell.value, str) and current_cell.value.strip() == ""):
-                        above_cell = sheet[f"{col_letter}{row_index - 1}"]
-                        current_cell.value = above_cell.value
+            first_columns = block.iloc[:, 0:10]
+            blank = first_columns.isna() | first_columns.apply(lambda column: column.astype(str).str.strip().eq(""))
+            block.iloc[:, 0:10] = ffill_blanks(first_columns.to_numpy(), blank.to_numpy())
 
             # Special fill for Column 4 based on Column 3
             st.write("Applying special fill for Column 4...")
-            for row_index in range(start_row + 1, end_row_for_processing + 1):
-                col_c_value = sheet.cell(row=row_index, column=3).value
-                col_d_cell = sheet.cell(row=row_index, column=4)
-
-                if (col_c_value is not None and str(col_c_value).strip() != "") and \
-                        (col_d_cell.value is None or str(col_d_cell.value).strip() == ""):
-                    col_d_cell.value = "(empty subsection)"
-
-        # Define valid values for column 6 for conditional filling of columns 14-15
-        # NOTE: This list of Field IDs (valid_values) is still needed for conditional filling in the Excel processing.
-        valid_values = {10, 11, 12, 14, 15, 17, 18, 19, 28, 29, 30, 94, 103, 104, 107, 108, 109, 117,
-                        119, 120, 122, 128, 130, 131, 142, 160, 168, 170, 206, 208, 209, 212, 214, 216,
-                        217, 220, 221, 222, 223, 224, 225, 226, 227, 228, 284, 292, 293, 311, 314, 315,
-                        316, 320, 325, 326, 371, 431, 980, 995, 1391, 1401, 1404, 1672, 1673, 1759, 2329,
-                        2440, 2472, 2473, 2485, 2486, 2500, 2502, 3282, 3708, 3709, 3875, 4240, 4243,
-                        4244, 4245, 5894, 5901, 5940, 7349, 8829, 8830, 9114, 9115, 9116, 9117, 9118, 9119,
-                        9120, 9121, 9122, 9126, 9127, 9128, 9129, 9130, 9135, 9136, 9137, 9138, 9139, 9140,
-                        9141, 9142, 9143, 9144, 9145, 9150, 9151, 9152, 9153, 9154, 9155, 9156, 9157, 9158,
-                        9179, 9180, 9181, 9189, 9191, 9192, 9201, 9202, 9203, 9204, 9205, 9206, 9207, 9208,
-                        9276, 9277, 9278, 9279, 9280, 9281, 9282, 9298, 9299, 9333, 9529, 9540, 9543, 9544,
-                        9552, 9557, 9565, 10614, 10618, 12739, 12960, 15463, 23157, 23159}
+            has_section = block[2].notna() & block[2].astype(str).str.strip().ne("")
+            no_subsection = block[3].isna() | block[3].astype(str).str.strip().eq("")
+            block.loc[has_section & no_subsection & (block.index > 0), 3] = "(empty subsection)"
 
-        if end_row_for_processing >= start_row:
             # Fill blank cells in columns 14 to 15 based on conditions
             st.write("Applying conditional fill for columns 14-15...")
-            for row_index in range(start_row + 1, end_row_for_processing + 1):
-                col_10_value = sheet.cell(row=row_index, column=10).value
-                try:
-                    # Column 6 (F) is 'Field ID', which is sometimes numeric
-                    col_6_value = int(sheet.cell(row=row_index, column=6).value)
-                except (ValueError, TypeError):
-                    col_6_value = None
-
-                # Condition: Field Type is "Dropdown select" (Col 10) AND Field ID (Col 6) is in the valid list
-                if col_10_value == "Dropdown select" and col_6_value in valid_values:
-                    for col_index in range(14, 16):  # Checks columns N (14) and O (15)
-                        col_letter = get_column_letter(col_index)
-                        current_cell = sheet[f"{col_letter}{row_index}"]
-                        if current_cell.value is None:
-                            above_cell = sheet[f"{col_letter}{row_index - 1}"]
-                            current_cell.value = above_cell.value
-
-        # Delete rows if "Bird species" criteria was met
-        if sheet.max_row >= end_row_for_deletion:
-            amount_to_delete = sheet.max_row - end_row_for_deletion + 1
+            # Condition: Field Type is "Dropdown select" (Col 10) AND Field ID (Col 6) is in the valid list.
+            # Column 6 (F) is 'Field ID', which is sometimes numeric; anything non-numeric never matches.
+            field_ids = pd.to_numeric(block[5], errors="coerce")
+            is_valid_dropdown = block[9].eq("Dropdown select") & field_ids.isin(VALID_FIELD_IDS) & (block.index > 0)
+            eccairs_columns = block.iloc[:, 13:15]  # Checks columns N (14) and O (15)
+            blank = eccairs_columns.isna().to_numpy() & is_valid_dropdown.to_numpy()[:, None]
+            block.iloc[:, 13:15] = ffill_blanks(eccairs_columns.to_numpy(), blank)
+
+            rows[start_row - 1:end_row_for_processing] = block.to_numpy().tolist()
+
+        # Delete rows if "Bird species" criteria was met. Only the kept rows are written out,
+        # so the deletion is a plain slice.
+        if max_row >= end_row_for_deletion:
+            amount_to_delete = max_row - end_row_for_deletion + 1
             if amount_to_delete > 0:
                 st.write(f"🗑️ Removed {amount_to_delete} rows starting from row {end_row_for_deletion}.")
-                sheet.delete_rows(end_row_for_deletion, amount_to_delete)
-
-        # Save the processed workbook to a BytesIO object
-        output_buffer = io.BytesIO()
-        wb.save(output_buffer)
+                del rows[end_row_for_deletion - 1:]
 
-        return output_buffer.getvalue(), valid_values
+        # Hand the processed rows straight to the later phases as a DataFrame
+        return rows_to_dataframe(rows), VALID_FIELD_IDS
 
     except KeyError:
         # This is now handled with an explicit check above, but keeping the catch-all
@@ -209,150 +346,169 @@ def process_excel_st(uploaded_file, sheet_name="Worksheet", start_row=1):
         return None, None
 
 
-# --- Word Form Generation Function (PHASE 3: READS Session State) ---
-def create_forms_from_excel_st(excel_bytes, folder_name):
+# --- Word Form Generation Function (PHASE 3) ---
+def build_form_document(form_desc, form_id, form_group, options_by_field, show_all_options, today_date_str):
     """
-    Generates Word documents based on the processed Excel, reading large option choices
-    from st.session_state.
+    Builds the Word document of a single form and returns its (filename, bytes).
     """
-    try:
-        # Read the Excel data from bytes into a DataFrame
-        df = pd.read_excel(io.BytesIO(excel_bytes))
+    document = Document()
+    document.add_heading(f'Form: {form_desc} [{form_id}]', level=0)
+
+    # Sort the form's rows by Position ID once; every section and subsection group sliced
+    # from it below keeps this order
+    form_group = form_group.sort_values(by="Position ID", kind="stable")
+
+    # Sections in order of their minimum Position ID: as form_group is sorted, groupby(sort=False)
+    # yields them by first occurrence, and splits the rows in one pass instead of one filter per section
+    for section, section_group in form_group.groupby("Section", sort=False):
+        document.add_heading(section, level=1)
+
+        # Subsections in order of their minimum Position ID
+        for subsection_header, subsection_group in section_group.groupby("Subsection Header", sort=False):
+            # Use the flag normalized once above rather than re-normalizing the header per group
+            if not subsection_group['_no_subsection'].iat[0]:
+                document.add_heading(subsection_header, level=2)
+            else:
+                subsection_group = section_group[section_group['_no_subsection']]
+                if subsection_group.empty:
+                    continue
 
-        st.info("Starting Word Form Generation...")
+            processed_field_ids_for_current_subsection = set()
 
-        # Column standardization (remains the same)
-        df["Form Description"] = df["Form Description"].astype(str).fillna("")
-        df["Section"] = df["Section"].astype(str).fillna("")
-        df["Subsection Header"] = df["Subsection Header"].astype(str).replace("nan", "n/a").fillna("")
-        df["Field ID"] = df["Field ID"].astype(str).fillna("")
-        df["Field Description"] = df["Field Description"].astype(str).fillna("")
-        df["Form ID"] = df["Form ID"].astype(str).fillna("")
-        df["Field Type"] = df["Field Type"].astype(str).fillna("")
-        df["Option"] = df["Option"].astype(str).replace("nan", "n/a").fillna("")
-        df["Mandatory"] = df["Mandatory"].astype(str).fillna("")
-        df["Eccairs Value ID"] = df["Eccairs Value ID"].astype(str).replace("nan", "n/a").fillna("")
-        df["Eccairs Value"] = df["Eccairs Value"].astype(str).replace("nan", "n/a").fillna("")
-
-        generated_files = []
-        today_date_str = date.today().strftime("%Y%m%d")
-
-        for (form_desc, form_id), form_group in df.groupby(["Form Description", "Form ID"]):
-            document = Document()
-            document.add_heading(f'Form: {form_desc} [{form_id}]', level=0)
-
-            # Sort sections by their minimum Position ID
-            unique_sections = form_group.groupby(form_group['Section'].astype(str))[
-                'Position ID'].min().sort_values().index
-
-            for section in unique_sections:
-                section_group = form_group[form_group['Section'].astype(str) == section]
-                document.add_heading(section, level=1)
-
-                # Sort subsections by their minimum Position ID
-                unique_subsections = section_group.groupby(section_group['Subsection Header'].astype(str))[
-                    'Position ID'].min().sort_values().index
-
-                for subsection_header in unique_subsections:
-                    if str(subsection_header).strip().lower() not in ("n/a", ""):
-                        document.add_heading(subsection_header, level=2)
-                        subsection_group = section_group[
-                            section_group['Subsection Header'].astype(str) == subsection_header]
-                    else:
-                        subsection_group = section_group[
-                            (section_group['Subsection Header'].astype(str).str.strip().str.lower() == "n/a") |
-                            (section_group['Subsection Header'].astype(str).str.strip() == "")
-                            ]
-                        if subsection_group.empty:
-                            continue
-
-                    processed_field_ids_for_current_subsection = set()
-
-                    # Get unique fields in the current subsection, sorted by Position ID
-                    unique_fields_in_subsection = subsection_group.sort_values(
-                        by="Position ID").drop_duplicates(subset=["Field ID"])
-
-                    for index, row in unique_fields_in_subsection.iterrows():
-                        field_id = str(row["Field ID"])  # Ensure Field ID is treated as a string for comparison
-                        field_desc = row["Field Description"]
-                        field_type = row["Field Type"]
-                        is_mandatory = str(row.get("Mandatory", "")).strip().upper() == "T"
-
-                        if field_id in processed_field_ids_for_current_subsection:
-                            continue
-
-                        # Apply safe_text_for_docx here for the display text as well, just in case
-                        display_field_desc = safe_text_for_docx(field_desc)
-                        display_field_desc = f"{display_field_desc}*" if is_mandatory else display_field_desc
-                        safe_field_id = safe_text_for_docx(field_id)
-
-                        if field_type == "Dropdown select":
-                            p = document.add_paragraph()
-                            p.add_run(f'{display_field_desc}: ').bold = True
-                            p.add_run(f'[{field_type}; {safe_field_id}]')
-
-                            # Fetch options unique to this Field ID
-                            options_for_field = df[
-                                (df["Field ID"].astype(str) == field_id) &
-                                (df["Option"].astype(str).str.lower() != "n/a") &
-                                (df["Option"].notna())
-                                ]["Option"].unique().tolist()
-
-                            if options_for_field:
-                                if len(options_for_field) > 50:
-                                    # Read the stored choice made in Phase 2
-                                    choice = st.session_state.get(f'config_choice_{field_id}', False)
-
-                                    if choice:
-                                        p_options_label = document.add_paragraph("Options:", style='Normal')
-                                        p_options_label.paragraph_format.left_indent = Inches(0.5)
-
-                                        for option in options_for_field:
-                                            # Use safe_text_for_docx here for high-volume content
-                                            safe_option = safe_text_for_docx(option)
-                                            p_option_bullet = document.add_paragraph(safe_option, style='List Bullet')
-                                            p_option_bullet.paragraph_format.left_indent = Inches(1.0)
-                                    else:
-                                        p_options_label = document.add_paragraph("Options:", style='Normal')
-                                        p_options_label.paragraph_format.left_indent = Inches(0.5)
-                                        p_grouped_options = document.add_paragraph(
-                                            "  Various options (more than 50 options) - Display skipped by user.",
-                                            style='Normal')
-                                        p_grouped_options.paragraph_format.left_indent = Inches(1.0)
-                                else:
-                                    # Small list: always display all options
-                                    p_options_label = document.add_paragraph("Options:", style='Normal')
-                                    p_options_label.paragraph_format.left_indent = Inches(0.5)
-
-                                    for option in options_for_field:
-                                        # Use safe_text_for_docx here
-                                        safe_option = safe_text_for_docx(option)
-                                        p_option_bullet = document.add_paragraph(safe_option, style='List Bullet')
-                                        p_option_bullet.paragraph_format.left_indent = Inches(1.0)
+            # Fields of the current subsection are already sorted by Position ID; repeated
+            # Field IDs (one row per option) are skipped via the set above
+            for field_id, field_desc, field_type, mandatory in subsection_group[
+                    ["Field ID", "Field Description", "Field Type", "Mandatory"]].itertuples(index=False, name=None):
+                is_mandatory = mandatory.strip().upper() == "T"
+
+                if field_id in processed_field_ids_for_current_subsection:
+                    continue
+
+                # Apply safe_text_for_docx here for the display text as well, just in case
+                display_field_desc = safe_text_for_docx(field_desc)
+                display_field_desc = f"{display_field_desc}*" if is_mandatory else display_field_desc
+                # Field IDs are normally plain ASCII digits, which the cleaner would return unchanged
+                safe_field_id = field_id if field_id.isascii() and field_id.isdigit() else safe_text_for_docx(field_id)
+
+                if field_type == "Dropdown select":
+                    p = document.add_paragraph()
+                    p.add_run(f'{display_field_desc}: ').bold = True
+                    p.add_run(f'[{field_type}; {safe_field_id}]')
+
+                    # Fetch options unique to this Field ID
+                    options_for_field = options_by_field.get(field_id, [])
+
+                    if options_for_field:
+                        if len(options_for_field) > 50:
+                            # The choice made in Phase 2
+                            choice = show_all_options.get(field_id, False)
+
+                            if choice:
+                                p_options_label = document.add_paragraph("Options:", style='Normal')
+                                p_options_label.paragraph_format.left_indent = INDENT_HALF_INCH
+
+                                add_option_bullets(document, options_for_field)
                             else:
-                                p_no_options = document.add_paragraph(
-                                    "  (No valid options defined or retrieved for this dropdown)", style='Normal')
-                                p_no_options.paragraph_format.left_indent = Inches(0.5)
+                                p_options_label = document.add_paragraph("Options:", style='Normal')
+                                p_options_label.paragraph_format.left_indent = INDENT_HALF_INCH
+                                p_grouped_options = document.add_paragraph(
+                                    "  Various options (more than 50 options) - Display skipped by user.",
+                                    style='Normal')
+                                p_grouped_options.paragraph_format.left_indent = INDENT_ONE_INCH
                         else:
-                            p = document.add_paragraph()
-                            p.add_run(f'{display_field_desc}: ').bold = True
-                            p.add_run(f'[{field_type}; {safe_field_id}] ')
-                            p.add_run('')
+                            # Small list: always display all options
+                            p_options_label = document.add_paragraph("Options:", style='Normal')
+                            p_options_label.paragraph_format.left_indent = INDENT_HALF_INCH
+
+                            add_option_bullets(document, options_for_field)
+                    else:
+                        p_no_options = document.add_paragraph(
+                            "  (No valid options defined or retrieved for this dropdown)", style='Normal')
+                        p_no_options.paragraph_format.left_indent = INDENT_HALF_INCH
+                else:
+                    p = document.add_paragraph()
+                    p.add_run(f'{display_field_desc}: ').bold = True
+                    p.add_run(f'[{field_type}; {safe_field_id}] ')
+                    p.add_run('')
+
+                processed_field_ids_for_current_subsection.add(field_id)
+            document.add_paragraph()
+
+    # Save the Word document to an in-memory buffer
+    doc_buffer = io.BytesIO()
+    document.save(doc_buffer)
+
+    # Clean filenames
+    clean_form_desc = clean_filename_part(form_desc)
+    clean_form_id = clean_filename_part(form_id)
+    output_filename = f"{clean_form_id}_{today_date_str}_{clean_form_desc}_form.docx"
 
-                        processed_field_ids_for_current_subsection.add(field_id)
-                    document.add_paragraph()
+    # getvalue() hands over the buffer's bytes without the extra copy that seek(0) + read() makes
+    return output_filename, doc_buffer.getvalue()
 
-            # Save the Word document to an in-memory buffer
-            doc_buffer = io.BytesIO()
-            document.save(doc_buffer)
-            doc_buffer.seek(0)
 
-            # Clean filenames
-            clean_form_desc = "".join(x for x in form_desc if x.isalnum() or x.isspace()).strip().replace(" ", "_")
-            clean_form_id = "".join(x for x in str(form_id) if x.isalnum() or x.isspace()).strip().replace(" ", "_")
-            output_filename = f"{clean_form_id}_{today_date_str}_{clean_form_desc}_form.docx"
+def generate_form_documents(processed_df, show_all_options, today_date_str):
+    """
+    Builds one Word document per form and returns a list of (filename, bytes). Reads no session
+    state: `show_all_options` maps the Field ID of every large dropdown to its Phase 2 choice.
+    """
+    # Work on a copy so the DataFrame cached in session state is left untouched
+    df = processed_df.copy()
+
+    # Column standardization (remains the same)
+    df["Form Description"] = df["Form Description"].astype(str).fillna("")
+    df["Section"] = df["Section"].astype(str).fillna("")
+    df["Subsection Header"] = df["Subsection Header"].astype(str).replace("nan", "n/a").fillna("")
+    df["Field ID"] = df["Field ID"].astype(str).fillna("")
+    df["Field Description"] = df["Field Description"].astype(str).fillna("")
+    df["Form ID"] = df["Form ID"].astype(str).fillna("")
+    df["Field Type"] = df["Field Type"].astype(str).fillna("")
+    df["Option"] = df["Option"].astype(str).replace("nan", "n/a").fillna("")
+    df["Mandatory"] = df["Mandatory"].astype(str).fillna("")
+    df["Eccairs Value ID"] = df["Eccairs Value ID"].astype(str).replace("nan", "n/a").fillna("")
+    df["Eccairs Value"] = df["Eccairs Value"].astype(str).replace("nan", "n/a").fillna("")
+
+    # Every column used below is a string from here on; flag the rows without a real subsection once as well
+    df["_no_subsection"] = df["Subsection Header"].str.strip().str.lower().isin(("n/a", ""))
+
+    # Look up the options of every dropdown field once instead of scanning the DataFrame per field
+    options_by_field = group_options_by_field(df)
+
+    generated_files = [
+        build_form_document(form_desc, form_id, form_group, options_by_field, show_all_options, today_date_str)
+        for (form_desc, form_id), form_group in df.groupby(["Form Description", "Form ID"])
+    ]
+
+    # Cleaned names can collide (e.g. Form IDs 'A-1' and 'A1'); number the repeats so every form
+    # keeps its own entry in the download selector and the ZIP
+    used_filenames = set()
+    for index, (filename, file_bytes) in enumerate(generated_files):
+        stem, extension = os.path.splitext(filename)
+        unique_filename, count = filename, 1
+        while unique_filename in used_filenames:
+            count += 1
+            unique_filename = f"{stem}_{count}{extension}"
+        used_filenames.add(unique_filename)
+        generated_files[index] = (unique_filename, file_bytes)
+
+    return generated_files
+
+
+# --- Word Form Generation Function (PHASE 3: READS Session State) ---
+def create_forms_from_excel_st(processed_df, folder_name):
+    """
+    Generates Word documents based on the processed Excel DataFrame, reading large option choices
+    from st.session_state.
+    """
+    try:
+        st.info("Starting Word Form Generation...")
 
-            generated_files.append((output_filename, doc_buffer.read()))
+        # Read the Phase 2 choices once, so the generator itself never touches session state
+        show_all_options = {
+            field_id: bool(st.session_state.get(f'config_choice_{field_id}', False))
+            for field_id, _, _ in st.session_state.get('large_dropdowns', [])
+        }
+        generated_files = generate_form_documents(processed_df, show_all_options, date.today().strftime("%Y%m%d"))
 
         if generated_files:
             st.success(f"✅ Successfully generated {len(generated_files)} Word forms.")
@@ -361,14 +517,53 @@ def create_forms_from_excel_st(excel_bytes, folder_name):
 
         return generated_files
 
-    except pd.errors.EmptyDataError:
-        st_display_error("Error", "The Excel file is empty or has no data for form generation.")
-        return None
     except Exception as e:
         st_display_error("An Error Occurred", f"An unexpected error occurred during Word form creation: {e}")
         return None
 
 
+def write_files_to_temp_dir(files):
+    """
+    Writes the generated (filename, bytes) pairs to a new temporary directory and returns the
+    TemporaryDirectory with the matching (filename, path) pairs, so session state only holds paths.
+    Kept in session state, the TemporaryDirectory deletes itself when the session is garbage-collected
+    (tab closed, refresh, timeout), not only on Start Over.
+    """
+    temp_dir = tempfile.TemporaryDirectory(prefix="generated_forms_")
+    directory = temp_dir.name
+    file_paths = []
+    for index, (filename, file_bytes) in enumerate(files):
+        # Numbered names on disk, as two forms can clean up to the same filename
+        path = os.path.join(directory, f"{index}.docx")
+        with open(path, 'wb') as f:
+            f.write(file_bytes)
+        file_paths.append((filename, path))
+
+    return temp_dir, file_paths
+
+
+def build_zip_file(files, zip_path):
+    """
+    Packs the generated (filename, path) pairs into one ZIP archive at zip_path, copying one file
+    at a time. The path is kept in st.session_state['zip_path'] so Streamlit reruns (e.g. clicking
+    an individual download) reuse the archive.
+    """
+    # All entries share one timestamp, taken once instead of a localtime() call per entry
+    date_time = time.localtime()[:6]
+
+    # DOCX files are already deflated internally, so they are stored without recompression unless
+    # the batch is large enough for the (fastest level) deflate pass to be worth its time
+    total_size = sum(os.path.getsize(path) for _, path in files)
+    compression = zipfile.ZIP_STORED if total_size < ZIP_DEFLATE_THRESHOLD else zipfile.ZIP_DEFLATED
+
+    with zipfile.ZipFile(zip_path, 'w', compression, allowZip64=True, compresslevel=1) as zip_file:
+        for filename, path in files:
+            info = zipfile.ZipInfo(filename, date_time=date_time)
+            info.external_attr = 0o600 << 16  # Same permissions writestr() gives a plain filename
+            with open(path, 'rb') as source:
+                zip_file.writestr(info, source.read(), compress_type=compression, compresslevel=1)
+
+
 # ----------------------------------------------------------------------------------
 # --- ECCAIRS Mappings and Duplicates Documents (REMOVED as requested) ---
 # ----------------------------------------------------------------------------------
@@ -377,14 +572,21 @@ def create_forms_from_excel_st(excel_bytes, folder_name):
 # REMOVED: def create_eccairs_dropdown_mappings_document_st(...)
 # REMOVED: def create_missing_eccairs_mappings_document_st(...)
 # REMOVED: def create_potential_duplicate_fields_document_st(...)
+# NOTE: If any of these are brought back, they should take the shared processed DataFrame
+# (st.session_state['processed_df']) like create_forms_from_excel_st, not re-parse Excel bytes.
 
 
 # --- Streamlit Main Application Logic (Multi-Phase) ---
 
 def reset_app_state():
     """Clears all processing-related keys from session state."""
-    keys_to_delete = ['processed_excel_bytes', 'valid_values', 'config_done',
-                      'large_dropdowns', 'generated_files', 'file_processed', 'select_all_large_options']
+    # Remove the documents written to disk for the previous run
+    if st.session_state.get('generated_dir') is not None:
+        st.session_state['generated_dir'].cleanup()
+
+    keys_to_delete = ['processed_df', 'valid_values', 'config_done',
+                      'large_dropdowns', 'generated_files', 'generated_dir', 'zip_path', 'file_processed',
+                      'select_all_large_options']
     for key in keys_to_delete:
         if key in st.session_state:
             del st.session_state[key]
@@ -481,44 +683,22 @@ def main_app():
 
     # PHASE 1: Upload and Pre-process
     # Check if a file is uploaded AND if the processed data is NOT yet in state
-    if uploaded_file is not None and st.session_state.get('processed_excel_bytes') is None:
+    if uploaded_file is not None and st.session_state.get('processed_df') is None:
         if st.button("1. Start Pre-processing", key='btn_preprocess'):
             # Reset state for a new file/process start
             reset_app_state()
 
             with st.spinner("Processing Excel and identifying fields..."):
                 # Pass the uploaded file object directly, process_excel_st reads the bytes
-                processed_excel_bytes, valid_values = process_excel_st(uploaded_file)
+                processed_df, valid_values = process_excel_st(uploaded_file)
 
-                if processed_excel_bytes is not None:
-                    st.session_state['processed_excel_bytes'] = processed_excel_bytes
+                if processed_df is not None:
+                    st.session_state['processed_df'] = processed_df
                     st.session_state['valid_values'] = valid_values
 
                     # Identify large dropdowns here
                     try:
-                        # Use the processed bytes to analyze the data
-                        temp_df = pd.read_excel(io.BytesIO(processed_excel_bytes))
-                        large_dropdowns = []
-
-                        # Use the same column names as used in the generation functions
-                        unique_dropdowns = temp_df[
-                            temp_df["Field Type"].astype(str).str.strip().str.lower() == "dropdown select"
-                            ].drop_duplicates(subset=["Field ID"])[["Field ID", "Field Description"]]
-
-                        for index, row in unique_dropdowns.iterrows():
-                            field_id = str(row["Field ID"])
-                            field_desc = row["Field Description"]
-
-                            # Count the unique options for this field ID
-                            options_count = temp_df[
-                                (temp_df["Field ID"].astype(str) == field_id) &
-                                (temp_df["Option"].astype(str).str.lower() != "n/a") &
-                                (temp_df["Option"].notna())
-                                ]["Option"].nunique()
-
-                            if options_count > 50:
-                                large_dropdowns.append((field_id, field_desc, options_count))
-
+                        large_dropdowns = find_large_dropdowns(processed_df)
                         st.session_state['large_dropdowns'] = large_dropdowns
                         st.success("Pre-processing complete. Proceed to Step 2 to configure form generation.")
                         st.session_state['file_processed'] = True
@@ -527,10 +707,10 @@ def main_app():
                         st_display_error("Data Analysis Error",
                                          f"Failed to analyze processed data for large dropdowns: {e}")
                         # Clear the processed data to force re-upload
-                        st.session_state['processed_excel_bytes'] = None
+                        st.session_state['processed_df'] = None
 
     # PHASE 2: Configure Large Options (The Pause)
-    if st.session_state.get('processed_excel_bytes') is not None and not st.session_state.get('config_done', False):
+    if st.session_state.get('processed_df') is not None and not st.session_state.get('config_done', False):
 
         large_dropdowns = st.session_state['large_dropdowns']
 
@@ -577,7 +757,7 @@ def main_app():
                 st.rerun()  # Rerun to move to the next step
 
     # PHASE 3: Generate and Download
-    if st.session_state.get('config_done', False) and st.session_state.get('processed_excel_bytes') is not None:
+    if st.session_state.get('config_done', False) and st.session_state.get('processed_df') is not None:
 
         st.header("3. Generate Documents & Download")
 
@@ -589,7 +769,7 @@ def main_app():
 
                 # 1. Main Form Generation
                 generated_forms = create_forms_from_excel_st(
-                    st.session_state['processed_excel_bytes'],
+                    st.session_state['processed_df'],
                     st.session_state['folder_name']
                 )
 
@@ -598,7 +778,11 @@ def main_app():
                 # Consolidate results
                 all_generated_files = generated_forms if generated_forms else []
 
-                st.session_state['generated_files'] = all_generated_files
+                # Keep the documents on disk rather than holding every file's bytes in session state
+                generated_dir, generated_files = write_files_to_temp_dir(all_generated_files)
+                st.session_state['generated_dir'] = generated_dir
+                st.session_state['generated_files'] = generated_files
+                st.session_state['zip_path'] = None  # Built from the new files on first use below
                 st.success("Document generation complete! Use the buttons below to download.")
 
         # --- Download Logic (Always runs if files are in state) ---
@@ -608,40 +792,51 @@ def main_app():
 
             all_files_to_zip = st.session_state['generated_files']
 
-            # Individual Downloads
+            # Individual Downloads: one button for the selected form, so only that file's bytes are
+            # sent to the browser on each rerun instead of every generated document
             st.markdown("##### Individual Documents:")
-            for filename, file_bytes in all_files_to_zip:
-                label_prefix = "Form" # Only Forms are left
+            # Options are list positions, as two forms can clean up to the same filename
+            selected_index = st.selectbox("Select a form", range(len(all_files_to_zip)),
+                                          format_func=lambda index: all_files_to_zip[index][0],
+                                          key="selected_form")
+            filename, path = all_files_to_zip[selected_index]
+            label_prefix = "Form" # Only Forms are left
+            with open(path, 'rb') as selected_file:
                 st.download_button(
                     label=f"⬇️ Download {label_prefix}: {filename}",
-                    data=file_bytes,
+                    data=selected_file,
                     file_name=filename,
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    key=f"download_{filename}"
+                    key="download_selected_form"
                 )
 
-            # Zip Download
-            if all_files_to_zip:
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip_file:
-                    for filename, file_bytes in all_files_to_zip:
-                        zip_file.writestr(filename, file_bytes)
-
-                zip_buffer.seek(0)
-
-                clean_folder_name = "".join(
-                    x for x in st.session_state['folder_name'] if x.isalnum() or x.isspace()).strip().replace(" ", "_")
+            # Zip Download: a single form is already downloadable above, so no archive is offered for it
+            if len(all_files_to_zip) > 1:
+                clean_folder_name = clean_filename_part(st.session_state['folder_name'])
                 zip_filename = f"{clean_folder_name}_Generated_Forms.zip" # Updated zip filename
 
                 st.markdown("---")
                 st.subheader("All Files in One Zip")
-                st.download_button(
-                    label=f"📦 Download All {len(all_files_to_zip)} Files as ZIP: {zip_filename}",
-                    data=zip_buffer.getvalue(),
-                    file_name=zip_filename,
-                    mime="application/zip",
-                    key="download_all_zip"
-                )
+
+                # The archive is only built when asked for, once per generation, next to the documents;
+                # users who only download individual forms never pay for it
+                if st.session_state.get('zip_path') is None:
+                    if st.button("📦 Prepare ZIP archive", key="btn_prepare_zip"):
+                        with st.spinner("Building ZIP archive..."):
+                            zip_path = os.path.join(st.session_state['generated_dir'].name, "forms.zip")
+                            build_zip_file(all_files_to_zip, zip_path)
+                            st.session_state['zip_path'] = zip_path
+                        st.rerun()  # Rerun so the Prepare button is replaced by the download button
+
+                if st.session_state.get('zip_path') is not None:
+                    with open(st.session_state['zip_path'], 'rb') as zip_file:
+                        st.download_button(
+                            label=f"📦 Download All {len(all_files_to_zip)} Files as ZIP: {zip_filename}",
+                            data=zip_file,
+                            file_name=zip_filename,
+                            mime="application/zip",
+                            key="download_all_zip"
+                        )
 
         # --- START OVER BUTTON (MOVED HERE) ---
         st.markdown("---")
@@ -652,26 +847,25 @@ def main_app():
 
 
 if __name__ == "__main__":
-    # Initialize session state variables for multi-step persistence
-    if 'processed_excel_bytes' not in st.session_state:
-        st.session_state['processed_excel_bytes'] = None
-    if 'valid_values' not in st.session_state:
-        st.session_state['valid_values'] = set()
-    if 'folder_name' not in st.session_state:
-        st.session_state['folder_name'] = "IQSMS_Forms_Export"
-
-    # State variables for multi-step process
-    if 'config_done' not in st.session_state:
-        st.session_state['config_done'] = False
-    if 'large_dropdowns' not in st.session_state:
-        st.session_state['large_dropdowns'] = []
-    if 'generated_files' not in st.session_state:
-        st.session_state['generated_files'] = None
-    if 'file_processed' not in st.session_state:
-        st.session_state['file_processed'] = False
-
-    # State variable for the "Select All" feature
-    if 'select_all_large_options' not in st.session_state:
-        st.session_state['select_all_large_options'] = False
-
-    main_app()
\ No newline at end of file
+    # Initialize session state variables for multi-step persistence. The literal is built on every
+    # run, so each session gets its own mutable defaults.
+    session_defaults = {
+        'processed_df': None,
+        'valid_values': frozenset(),
+        'folder_name': "IQSMS_Forms_Export",
+
+        # State variables for multi-step process
+        'config_done': False,
+        'large_dropdowns': [],
+        'generated_files': None,
+        'generated_dir': None,
+        'zip_path': None,
+        'file_processed': False,
+
+        # State variable for the "Select All" feature
+        'select_all_large_options': False,
+    }
+    for key, default in session_defaults.items():
+        st.session_state.setdefault(key, default)
+
+    main_app()